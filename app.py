@@ -1,8 +1,7 @@
 import streamlit as st
 import pandas as pd
-from supabase import create_client, Client
+import numpy as np
 import requests
-import json
 
 # OBTENER LA CLAVE DE SERVICIO PARA AUTORIZACIÓN
 # Ya se obtiene desde secrets.toml
@@ -19,6 +18,9 @@ st.set_page_config(
 @st.cache_resource
 def init_connection():
     """Inicializa la conexión a Supabase."""
+    # Import diferido: solo se paga una vez, dentro de la caché de recursos
+    from supabase import create_client
+
     try:
         url = st.secrets["supabase"]["url"]
         key = st.secrets["supabase"]["anon_key"]
@@ -27,7 +29,7 @@ def init_connection():
         st.error(f"Error al conectar con Supabase. Revise 'secrets.toml'. {e}")
         return None
 
-supabase: Client = init_connection()
+supabase = init_connection()
 
 if not supabase:
     st.stop()
@@ -35,40 +37,90 @@ if not supabase:
 # URL de la Edge Function (evaluar_ofertas_sigsel)
 EDGE_FUNCTION_URL = st.secrets["edge_function"]["url"]
 
+# Constantes de presentación (no se reconstruyen en cada rerun)
+COLUMNAS_RANKING = ['razon_social', 'monto_ofertado', 'puntaje_precio', 'puntaje_tecnico', 'puntaje_total']
+COLUMNAS_PUNTAJE = ['puntaje_precio', 'puntaje_tecnico', 'puntaje_total']
+DISPLAY_FORMAT = {'monto_ofertado': 'S/ {:,.2f}', **dict.fromkeys(COLUMNAS_PUNTAJE, '{:.2f}')}
+TABLE_STYLES = [
+    {'selector': 'th', 'props': [('background-color', '#004d40'), ('color', 'white'), ('font-size', '14px')]},
+    {'selector': 'td', 'props': [('font-size', '14px')]}
+]
+
 # --- Funciones de Datos ---
 
 @st.cache_data(ttl=60)
-def fetch_expedientes():
-    """Obtiene la lista de expedientes de contratación."""
+def fetch_expedientes_con_ofertas():
+    """Obtiene en una sola consulta los expedientes y sus ofertas embebidas (PostgREST)."""
     try:
         # Usa el cliente con ANON KEY para leer datos públicos/permitidos
-        response = supabase.table("expedientes_contratacion").select("id, codigo_proceso, objeto_contrato, estado_fase").execute()
-        return pd.DataFrame(response.data)
+        response = supabase.table("expedientes_contratacion").select(
+            "id, codigo_proceso, objeto_contrato, estado_fase, "
+            "ofertas_recibidas(razon_social, monto_ofertado, puntaje_precio, puntaje_tecnico, puntaje_total)"
+        ).execute()
+        data = response.data
+        # Listas paralelas en un dict (tipos builtin, se serializan sin depender del script)
+        expedientes = {
+            'ids': [exp['id'] for exp in data],
+            'codes': [exp['codigo_proceso'] for exp in data],
+            'objetos': [exp['objeto_contrato'] for exp in data],
+            'estados': [exp['estado_fase'] for exp in data],
+        }
+        # Índice por ID construido una sola vez para que fetch_ofertas no recorra toda la respuesta
+        ofertas_por_id = {exp['id']: exp.get('ofertas_recibidas') or [] for exp in data}
+        return expedientes, ofertas_por_id
     except Exception as e:
         st.error(f"Error al cargar expedientes: {e}")
-        return pd.DataFrame()
+        return {'ids': [], 'codes': [], 'objetos': [], 'estados': []}, {}
+
+def fetch_expedientes():
+    """Obtiene la lista de expedientes de contratación como listas paralelas (ids, codes, objetos, estados)."""
+    expedientes, _ = fetch_expedientes_con_ofertas()
+    return expedientes
 
+@st.cache_data(ttl=60)
 def fetch_ofertas(expediente_id):
-    """Obtiene las ofertas para un expediente dado."""
+    """Obtiene las ofertas para un expediente dado (en caché por expediente_id) desde la consulta embebida."""
+    import pyarrow as pa
+
     try:
-        # Usa el cliente con ANON KEY para leer datos públicos/permitidos
-        response = supabase.table("ofertas_recibidas").select("*").eq("expediente_id", expediente_id).execute()
-        return pd.DataFrame(response.data)
+        _, ofertas_por_id = fetch_expedientes_con_ofertas()
+        # Construcción directa en Arrow: evita la inferencia de tipos de pandas sobre objetos Python
+        return pa.Table.from_pylist(ofertas_por_id.get(expediente_id, [])).to_pandas(types_mapper=pd.ArrowDtype)
     except Exception as e:
         st.error(f"Error al cargar ofertas: {e}")
         return pd.DataFrame()
 
-def call_edge_function(expediente_id):
-    """Llama a la Edge Function de Supabase para iniciar el cálculo, incluyendo el header de autorización."""
+@st.cache_data(ttl=60)
+def build_display_df(expediente_id):
+    """Prepara la tabla de ranking (orden, posición y redondeo) de un expediente; en caché por expediente_id."""
+    ofertas_df = fetch_ofertas(expediente_id)
+    if ofertas_df.empty:
+        return ofertas_df
+
+    # Ordenar por puntaje total (descendente); sort_values ya devuelve un nuevo DataFrame
+    display_df = ofertas_df[COLUMNAS_RANKING].sort_values(by='puntaje_total', ascending=False).reset_index(drop=True)
+    display_df.insert(0, 'ranking', np.arange(1, len(display_df) + 1))
+
+    # El formato de moneda se aplica al renderizar (Styler.format); aquí los montos siguen siendo numéricos
+    return display_df.round(dict.fromkeys(COLUMNAS_PUNTAJE, 2))
+
+@st.cache_resource
+def edge_function_session():
+    """Sesión HTTP reutilizable (keep-alive) para la Edge Function, con el header de autorización."""
+    session = requests.Session()
     # 🚨 SOLUCIÓN: Usar la clave de Service Role en el encabezado
-    headers = {
+    session.headers.update({
         "Content-Type": "application/json",
         "Authorization": f"Bearer {SERVICE_ROLE_KEY}" # Aquí se añade la clave secreta
-    }
+    })
+    return session
+
+def call_edge_function(expediente_id):
+    """Llama a la Edge Function de Supabase para iniciar el cálculo, reutilizando la conexión."""
     payload = {"expediente_id": expediente_id}
     
     try:
-        response = requests.post(EDGE_FUNCTION_URL, headers=headers, json=payload)
+        response = edge_function_session().post(EDGE_FUNCTION_URL, json=payload, timeout=30)
         
         if response.status_code == 200:
             return True, response.json()
@@ -83,79 +135,33 @@ st.title("Sistema SIG-SEL: Módulo de Evaluación Automática")
 st.caption("Prototipo Funcional para la Fase de Selección. Eliminando subjetividad en la calificación.")
 
 # --- Sidebar para Selección de Expediente ---
-expedientes_df = fetch_expedientes()
+expedientes = fetch_expedientes()
 
 with st.sidebar:
     st.header("Selección de Expediente")
-    if expedientes_df.empty:
+    if len(expedientes['ids']) == 0:
         st.warning("No hay expedientes cargados. Por favor, revise la BD.")
         st.stop()
 
-    # Mapeo para mostrar el código pero usar el ID internamente
-    expediente_options = {row['codigo_proceso']: row['id'] for index, row in expedientes_df.iterrows()}
-    
-    selected_code = st.selectbox(
+    # Se muestra el código pero se trabaja con la posición, que indexa directamente las listas
+    selected_idx = st.selectbox(
         "Seleccione el Código del Proceso:",
-        options=list(expediente_options.keys()),
+        options=range(len(expedientes['ids'])),
+        format_func=lambda i: expedientes['codes'][i],
         index=0
     )
     
-    selected_id = expediente_options[selected_code]
+    selected_code = expedientes['codes'][selected_idx]
+    selected_id = expedientes['ids'][selected_idx]
     st.write(f"ID del Expediente (BD): `{selected_id}`")
     
-    current_expediente = expedientes_df[expedientes_df['id'] == selected_id].iloc[0]
-    st.info(f"Estado: {current_expediente['estado_fase']}")
-    st.write(f"Objeto: {current_expediente['objeto_contrato']}")
+    st.info(f"Estado: {expedientes['estados'][selected_idx]}")
+    st.write(f"Objeto: {expedientes['objetos'][selected_idx]}")
 
 
 # --- Main Content ---
 st.header(f"Expediente a Evaluar: {selected_code}")
 
-# 1. Obtener Ofertas
-# Importante: Volver a llamar a fetch_ofertas después de call_edge_function para refrescar
-ofertas_df = fetch_ofertas(selected_id)
-
-if ofertas_df.empty:
-    st.warning("No se han cargado ofertas para este expediente.")
-    st.stop()
-
-# 2. Pre-procesamiento de datos para la tabla
-columnas_ranking = ['razon_social', 'monto_ofertado', 'puntaje_precio', 'puntaje_tecnico', 'puntaje_total']
-display_df = ofertas_df[columnas_ranking].copy()
-
-# Ordenar por puntaje total (descendente)
-display_df = display_df.sort_values(by='puntaje_total', ascending=False)
-display_df['ranking'] = range(1, len(display_df) + 1)
-display_df = display_df[['ranking'] + columnas_ranking]
-
-# Formato de moneda y números
-display_df['monto_ofertado'] = display_df['monto_ofertado'].apply(lambda x: f"S/ {x:,.2f}")
-display_df['puntaje_precio'] = display_df['puntaje_precio'].round(2)
-display_df['puntaje_tecnico'] = display_df['puntaje_tecnico'].round(2)
-display_df['puntaje_total'] = display_df['puntaje_total'].round(2)
-
-
-# 3. Botón de Ejecución del Motor de Cálculo
-col1, col2, col3 = st.columns([1, 1, 3])
-
-if col1.button("▶️ Ejecutar Motor de Calificación", type="primary", use_container_width=True):
-    with st.spinner("Llamando a la Edge Function... Calculando puntajes de forma objetiva..."):
-        # La Edge Function requiere la clave de Service Role para realizar la escritura
-        success, result = call_edge_function(selected_id)
-        
-        if success:
-            st.success("✅ Cálculo Finalizado con Éxito.")
-            st.toast("Puntajes actualizados en la base de datos.")
-            # Refrescar los datos de la app para mostrar los nuevos puntajes
-            st.cache_data.clear()
-            st.rerun()
-        else:
-            st.error(f"❌ Error en la Ejecución de la Edge Function.")
-            st.json(result)
-
-# 4. Visualización Profesional del Ranking
-st.subheader("Cuadro Comparativo y Ranking Final (Base 100)")
-
 # Función de estilo para destacar el ganador y el formato
 def style_ranking(df):
     """Aplica estilos al DataFrame para hacerlo más profesional y destacar el ganador."""
@@ -186,26 +192,68 @@ def style_ranking(df):
         {'selector': 'td', 'props': [('font-size', '14px')]}
     ]
 
+def highlight_winner(df):
+    """Devuelve los estilos CSS por celda, resaltando de una sola vez la fila del ganador (Ranking 1)."""
+    is_winner = df['ranking'].to_numpy()[:, None] == 1
+    styles = np.where(is_winner, 'background-color: #e6fff0; font-weight: bold', '')
+    return pd.DataFrame(np.broadcast_to(styles, df.shape), index=df.index, columns=df.columns)
 
-st.dataframe(
-    display_df.style.apply(lambda x: ['background-color: #e6fff0; font-weight: bold' if x['ranking'] == 1 else '' for i in x], axis=1)
-                .set_properties(**{'text-align': 'right'}, subset=['puntaje_precio', 'puntaje_tecnico', 'puntaje_total'])
-                .set_table_styles([
-                    {'selector': 'th', 'props': [('background-color', '#004d40'), ('color', 'white'), ('font-size', '14px')]},
-                    {'selector': 'td', 'props': [('font-size', '14px')]}
-                ]),
-    use_container_width=True,
-    hide_index=True
-)
 
-# 5. Conclusiones Rápidas
-ganador = display_df.iloc[0]
-st.metric(
-    label="Ganador (Buena Pro Provisional)", 
-    value=ganador['razon_social'], 
-    delta=f"Puntaje Total: {ganador['puntaje_total']} / 100", 
-    delta_color="normal"
-)
+@st.fragment
+def results_panel(selected_id):
+    """Panel de ofertas, motor de cálculo y ranking; sus widgets solo vuelven a ejecutar este fragmento."""
+    # 1-2. Obtener Ofertas y pre-procesar la tabla
+    # Importante: el resultado está en caché; tras call_edge_function se limpia con st.cache_data.clear()
+    display_df = build_display_df(selected_id)
+
+    if display_df.empty:
+        st.warning("No se han cargado ofertas para este expediente.")
+        st.stop()
+
+    # 3. Botón de Ejecución del Motor de Cálculo
+    # Al estar dentro del fragmento, pulsarlo no vuelve a ejecutar la barra lateral
+    col1, col2, col3 = st.columns([1, 1, 3])
+
+    if col1.button("▶️ Ejecutar Motor de Calificación", type="primary", use_container_width=True):
+        with st.spinner("Llamando a la Edge Function... Calculando puntajes de forma objetiva..."):
+            # La Edge Function requiere la clave de Service Role para realizar la escritura
+            success, result = call_edge_function(selected_id)
+        
+            if success:
+                st.success("✅ Cálculo Finalizado con Éxito.")
+                st.toast("Puntajes actualizados en la base de datos.")
+                # Refrescar los datos de la app para mostrar los nuevos puntajes
+                st.cache_data.clear()
+                st.rerun()
+            else:
+                st.error(f"❌ Error en la Ejecución de la Edge Function.")
+                st.json(result)
+
+    # 4. Visualización Profesional del Ranking
+    st.subheader("Cuadro Comparativo y Ranking Final (Base 100)")
+
+    st.dataframe(
+        display_df.style.apply(highlight_winner, axis=None)
+                    .set_properties(**{'text-align': 'right'}, subset=COLUMNAS_PUNTAJE)
+                    .set_table_styles(TABLE_STYLES)
+                    .format(DISPLAY_FORMAT, na_rep='-'),
+        use_container_width=True,
+        hide_index=True
+    )
+
+    # 5. Conclusiones Rápidas
+    ganador = display_df.iloc[0]
+    # Con tipos Arrow, un expediente aún no evaluado trae puntajes nulos (NA); se muestran como en la tabla
+    puntaje_ganador = '-' if pd.isna(ganador['puntaje_total']) else ganador['puntaje_total']
+    st.metric(
+        label="Ganador (Buena Pro Provisional)", 
+        value=ganador['razon_social'], 
+        delta=f"Puntaje Total: {puntaje_ganador} / 100", 
+        delta_color="normal"
+    )
+
+
+results_panel(selected_id)
 
 st.sidebar.markdown("---")
 st.sidebar.markdown(f"**Requisito Cubierto:** RF-04 (Asistencia a la Evaluación)")